@@ -12,6 +12,7 @@ import plotly.graph_objects as go
 from plotly.subplots import make_subplots
 import pandas as pd
 import argparse
+import metrics
 
 client = boto3.client('logs')
 arg_parser = argparse.ArgumentParser(description='AWS Logs Analyser')
@@ -24,26 +25,39 @@ logging.basicConfig(
 
 
 def camel_case_split(str):
+    metrics.count('regex_evaluations')
     return re.findall(r'[A-Z](?:[a-z]+|[A-Z]*(?=[A-Z]|$))', str)
 
 
 def get_logs(query, group_name, start_time, end_time):
     logging.info('Query: [{}]'.format(query))
-    start_query_response = client.start_query(
-        logGroupName=group_name,
-        startTime=int(start_time.timestamp()),
-        endTime=int(end_time.timestamp()),
-        queryString=query
-    )
+    with metrics.stage('query_submit'):
+        start_query_response = client.start_query(
+            logGroupName=group_name,
+            startTime=int(start_time.timestamp()),
+            endTime=int(end_time.timestamp()),
+            queryString=query
+        )
 
     query_id = start_query_response['queryId']
     response = None
     while response is None or response['status'] == 'Running':
         logging.info('Waiting for query to complete ...')
-        time.sleep(5)
+        with metrics.stage('poll_wait'):
+            time.sleep(5)
+        poll_start = time.perf_counter()
         response = client.get_query_results(
             queryId=query_id
         )
+        # Polls of a query that is still running are waiting on CloudWatch, only the final one transfers results
+        if response['status'] == 'Running':
+            metrics.add_time('poll_wait', time.perf_counter() - poll_start, calls=0)
+        else:
+            metrics.add_time('result_transfer', time.perf_counter() - poll_start)
+        metrics.count('query_polls')
+    metrics.count('rows_read', len(response['results']))
+    if 'statistics' in response:
+        metrics.count('bytes_scanned', int(response['statistics'].get('bytesScanned', 0)))
     return response
 
 
@@ -51,19 +65,20 @@ def get_log_stream_names(group_name, service_name, start_time, end_time):
     log_streams = []
     next_token = None
     while True:
-        if next_token is None:
-            response = client.describe_log_streams(
-                logGroupName=group_name,
-                logStreamNamePrefix=service_name,
-                limit=50
-            )
-        else:
-            response = client.describe_log_streams(
-                logGroupName=group_name,
-                logStreamNamePrefix=service_name,
-                nextToken=next_token,
-                limit=50
-            )
+        with metrics.stage('list_streams'):
+            if next_token is None:
+                response = client.describe_log_streams(
+                    logGroupName=group_name,
+                    logStreamNamePrefix=service_name,
+                    limit=50
+                )
+            else:
+                response = client.describe_log_streams(
+                    logGroupName=group_name,
+                    logStreamNamePrefix=service_name,
+                    nextToken=next_token,
+                    limit=50
+                )
         for log_stream in response['logStreams']:
             log_streams.append(log_stream)
         if 'nextToken' in response:
@@ -71,13 +86,15 @@ def get_log_stream_names(group_name, service_name, start_time, end_time):
         else:
             break
     log_stream_names = []
-    for log_stream in log_streams:
-        last_event_timestamp = datetime.fromtimestamp(int(log_stream['lastEventTimestamp']) / 1000)
-        first_event_timestamp = datetime.fromtimestamp(int(log_stream['firstEventTimestamp']) / 1000)
-        if first_event_timestamp >= start_time and last_event_timestamp <= end_time:
-            logging.debug(
-                '{} - from {} to {}'.format(log_stream['logStreamName'], first_event_timestamp, last_event_timestamp))
-            log_stream_names.append(log_stream['logStreamName'])
+    with metrics.stage('aggregate'):
+        for log_stream in log_streams:
+            last_event_timestamp = datetime.fromtimestamp(int(log_stream['lastEventTimestamp']) / 1000)
+            first_event_timestamp = datetime.fromtimestamp(int(log_stream['firstEventTimestamp']) / 1000)
+            if first_event_timestamp >= start_time and last_event_timestamp <= end_time:
+                logging.debug(
+                    '{} - from {} to {}'.format(log_stream['logStreamName'], first_event_timestamp,
+                                                last_event_timestamp))
+                log_stream_names.append(log_stream['logStreamName'])
     logging.debug('Log Streams: {}'.format(log_stream_names))
     logging.info('{} log streams are found'.format(len(log_stream_names)))
     return log_stream_names
@@ -109,22 +126,23 @@ def get_startup_logs_for_service(group_name, service_name, start_time, end_time)
 
     logging.info("Retrieved {} log entries from AWS for service {}".format(len(response['results']), service_name))
     messages = []
-    for entry in response['results']:
-        message = {}
-        match = False
-        for field in entry:
-            if field['field'] == '@logStream':
-                ls = field['value']
-                if ls in log_stream_names:
-                    match = True
-                    message['log_stream'] = ls
-            if match:
-                if field['field'] == 'details':
-                    message['message'] = field['value']
-                elif field['field'] == 'ts':
-                    message['timestamp'] = field['value']
-        if 'message' in message:
-            messages.append(message)
+    with metrics.stage('aggregate'):
+        for entry in response['results']:
+            message = {}
+            match = False
+            for field in entry:
+                if field['field'] == '@logStream':
+                    ls = field['value']
+                    if ls in log_stream_names:
+                        match = True
+                        message['log_stream'] = ls
+                if match:
+                    if field['field'] == 'details':
+                        message['message'] = field['value']
+                    elif field['field'] == 'ts':
+                        message['timestamp'] = field['value']
+            if 'message' in message:
+                messages.append(message)
 
     logging.info('{} entries are taken into account for analysis.'.format(len(messages)))
     return log_stream_names, messages
@@ -209,20 +227,21 @@ def get_startup_time_logs(group_name, start_time, end_time):
     response = get_logs(query, group_name, start_time, end_time)
 
     results = []
-    for entry in response['results']:
-        result = {}
-        for field in entry:
-            if field['field'] == 'appName':
-                split_app_name = camel_case_split(field['value'].replace('Application', '').replace('Service', ''))
-                result['name'] = ' '.join(split_app_name)
-            elif field['field'] == 'appStartTime':
-                result['appStart'] = field['value']
-            elif field['field'] == 'jvmStartTime':
-                result['jvmStart'] = field['value']
-        if 'name' in result:
-            results.append(result)
-        else:
-            logging.debug(entry)
+    with metrics.stage('aggregate'):
+        for entry in response['results']:
+            result = {}
+            for field in entry:
+                if field['field'] == 'appName':
+                    split_app_name = camel_case_split(field['value'].replace('Application', '').replace('Service', ''))
+                    result['name'] = ' '.join(split_app_name)
+                elif field['field'] == 'appStartTime':
+                    result['appStart'] = field['value']
+                elif field['field'] == 'jvmStartTime':
+                    result['jvmStart'] = field['value']
+            if 'name' in result:
+                results.append(result)
+            else:
+                logging.debug(entry)
     return results
 
 
@@ -343,11 +362,14 @@ def output_data_to_csv(env_name, start_time, end_time, data):
 
 
 def output_csv_file(filename, lines):
-    output_file = open(filename, "w")
-    for line in lines:
-        output_file.write(line)
-        output_file.write('\n')
-    output_file.close()
+    with metrics.stage('write'):
+        output_file = open(filename, "w")
+        for line in lines:
+            output_file.write(line)
+            output_file.write('\n')
+        output_file.close()
+    metrics.count('rows_written', len(lines))
+    metrics.count('bytes_written', sum(len(line) + 1 for line in lines))
     logging.info("{} lines are written to [{}]".format(len(lines), filename))
 
 
@@ -363,6 +385,10 @@ def main(argv):
     arg_parser.add_argument("-s", "--start", required=True, help="Start time (ISO-8601 format)")
     arg_parser.add_argument("-e", "--end", required=True, help="End time (ISO-8601 format)")
     arg_parser.add_argument("-svc", "--service", required=False, help="Service Name")
+    arg_parser.add_argument("--metrics-out", required=False,
+                            help="Write stage timings, counters and peak RSS as JSON to this file")
+    arg_parser.add_argument("--profile", action="store_true",
+                            help="Run under cProfile and dump the stats to disk")
     args = arg_parser.parse_args()
 
     env_name = args.log_group
@@ -375,15 +401,17 @@ def main(argv):
                                                                        start_time.isoformat(),
                                                                        end_time.isoformat()))
 
-    if service_name is not None:
-        log_stream_names, messages = get_startup_logs_for_service(env_name, service_name, start_time, end_time)
-        timings = analyse_startup_stages(log_stream_names, messages)
-        file_name = output_timings_data_to_csv(service_name, start_time, end_time, timings)
-        show_startup_time_breakdown_graph(service_name, file_name)
-    else:
-        results = get_startup_time_logs(env_name, start_time, end_time)
-        file_name = output_data_to_csv(env_name, start_time, end_time, results)
-        show_startup_time_graph(env_name, file_name)
+    with metrics.collect('awsanalyser', args.metrics_out, args.profile):
+        if service_name is not None:
+            log_stream_names, messages = get_startup_logs_for_service(env_name, service_name, start_time, end_time)
+            with metrics.stage('aggregate'):
+                timings = analyse_startup_stages(log_stream_names, messages)
+            file_name = output_timings_data_to_csv(service_name, start_time, end_time, timings)
+            show_startup_time_breakdown_graph(service_name, file_name)
+        else:
+            results = get_startup_time_logs(env_name, start_time, end_time)
+            file_name = output_data_to_csv(env_name, start_time, end_time, results)
+            show_startup_time_graph(env_name, file_name)
 
 
 main(sys.argv)
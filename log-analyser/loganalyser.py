@@ -1,11 +1,17 @@
 #!/usr/bin/python
 
+import bisect
+import json
 import logging
+import os
 import sys
 import csv
+import heapq
+import tempfile
 from pprint import pprint
 import re
-from datetime import datetime
+from datetime import datetime, timedelta
+import metrics
 
 logging.basicConfig(
     format='%(asctime)s %(levelname)-8s %(message)s',
@@ -13,14 +19,25 @@ logging.basicConfig(
     datefmt='%Y-%m-%d %H:%M:%S',
     handlers=[logging.StreamHandler(sys.stdout)])
 
+# Read-ahead buffer per log file when merging many of them, bounds the memory to one buffer per node
+READ_AHEAD_BYTES = 1024 * 1024
+# Only millisecond timestamps have the fixed width that keeps them in time order when compared as strings
+TIMESTAMP_PATTERN = re.compile(r'^\[(\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}\.\d{3}Z)\]')
+# The sparse timestamp index records the byte offset of every Nth line
+INDEX_EVERY_LINES = 1000
+INDEX_FILE_SUFFIX = '.tsidx'
+
 
 def read_hibernate_statistics(filename):
     reports = []
+    regex_evaluations = 0
 
-    with open(filename, newline='') as csvfile:
+    metrics.count('bytes_read', os.path.getsize(filename))
+    with metrics.stage('parse'), open(filename, newline='') as csvfile:
         reader = csv.DictReader(csvfile)
         for row in reader:
             message_lines = row['@message'].splitlines()
+            regex_evaluations += 3 * len(message_lines)
             batches = [line for line in message_lines if
                        re.search("^.*nanoseconds spent executing.*JDBC batches;$", line.strip())]
             batches_desc = batches[0].strip()
@@ -56,25 +73,28 @@ def read_hibernate_statistics(filename):
 
             }
             reports.append(report)
+    metrics.count('rows_read', len(reports))
+    metrics.count('regex_evaluations', regex_evaluations)
 
     csv_reports = []
     csv_reports.append(
         "timestamp,batch_time_ms,batches,statement_time_ms,statements,flush_time_ms,flushes,total_time_ms")
-    for report in reports:
-        if report['batches']['duration_ms'] > 200 \
-                or report['exec_statements']['duration_ms'] > 200 \
-                or report['exec_flushes']['duration_ms'] > 200:
-            total_time = report['batches']['duration_ms'] + \
-                         report['exec_statements']['duration_ms'] + \
-                         report['exec_flushes']['duration_ms']
-            csv_reports.append('{},{},{},{},{},{},{},{}'.format(report['timestamp'],
-                                                                report['batches']['duration_ms'],
-                                                                report['batches']['amount'],
-                                                                report['exec_statements']['duration_ms'],
-                                                                report['exec_statements']['amount'],
-                                                                report['exec_flushes']['duration_ms'],
-                                                                report['exec_flushes']['amount'],
-                                                                float("{0:.2f}".format(total_time))))
+    with metrics.stage('aggregate'):
+        for report in reports:
+            if report['batches']['duration_ms'] > 200 \
+                    or report['exec_statements']['duration_ms'] > 200 \
+                    or report['exec_flushes']['duration_ms'] > 200:
+                total_time = report['batches']['duration_ms'] + \
+                             report['exec_statements']['duration_ms'] + \
+                             report['exec_flushes']['duration_ms']
+                csv_reports.append('{},{},{},{},{},{},{},{}'.format(report['timestamp'],
+                                                                    report['batches']['duration_ms'],
+                                                                    report['batches']['amount'],
+                                                                    report['exec_statements']['duration_ms'],
+                                                                    report['exec_statements']['amount'],
+                                                                    report['exec_flushes']['duration_ms'],
+                                                                    report['exec_flushes']['amount'],
+                                                                    float("{0:.2f}".format(total_time))))
 
     output_file_name = "result_{}.csv".format(filename.replace('.', '_').replace('/', '_'))
     output_csv_file(output_file_name, csv_reports)
@@ -88,18 +108,24 @@ def read_hibernate_statistics(filename):
 
 
 def output_csv_file(filename, lines):
-    output_file = open(filename, "w")
-    for line in lines:
-        output_file.write(line)
-        output_file.write('\n')
-    output_file.close()
+    with metrics.stage('write'):
+        output_file = open(filename, "w")
+        for line in lines:
+            output_file.write(line)
+            output_file.write('\n')
+        output_file.close()
+    metrics.count('rows_written', len(lines))
+    metrics.count('bytes_written', sum(len(line) + 1 for line in lines))
 
 
 def get_timer_contents(filename, str_filter=None):
     contents = {}
-    with open(filename, newline='') as csvfile:
+    rows = 0
+    metrics.count('bytes_read', os.path.getsize(filename))
+    with metrics.stage('parse'), open(filename, newline='') as csvfile:
         reader = csv.DictReader(csvfile)
         for row in reader:
+            rows += 1
             method_name = str(row['method'])
             if str_filter is not None:
                 if str_filter not in method_name and str_filter not in str(row['parent']) and str_filter not in str(
@@ -123,21 +149,25 @@ def get_timer_contents(filename, str_filter=None):
                     'total': total,
                     'count': count
                 }
+    metrics.count('rows_read', rows)
     return contents
 
 
 def compare_timers(left, right):
     left_contents = get_timer_contents(left)
     right_contents = get_timer_contents(right)
-    diff_in_left_not_in_right_method_calls = {k: left_contents[k] for k in left_contents if k not in right_contents}
-    diff_in_right_not_in_left_method_calls = {k: right_contents[k] for k in right_contents if k not in left_contents}
-    time_delta = 5000
-    diff_values = {k: left_contents[k] for k in left_contents
-                   if k in right_contents
-                   # and abs(left_contents[k]['total'] - right_contents[k]['total']) > time_delta
-                   }
-    left_values = {k: left_contents[k] for k in left_contents if k in diff_values}
-    right_values = {k: right_contents[k] for k in right_contents if k in diff_values}
+    with metrics.stage('aggregate'):
+        diff_in_left_not_in_right_method_calls = {k: left_contents[k] for k in left_contents
+                                                  if k not in right_contents}
+        diff_in_right_not_in_left_method_calls = {k: right_contents[k] for k in right_contents
+                                                  if k not in left_contents}
+        time_delta = 5000
+        diff_values = {k: left_contents[k] for k in left_contents
+                       if k in right_contents
+                       # and abs(left_contents[k]['total'] - right_contents[k]['total']) > time_delta
+                       }
+        left_values = {k: left_contents[k] for k in left_contents if k in diff_values}
+        right_values = {k: right_contents[k] for k in right_contents if k in diff_values}
 
     result = {
         'left': left_values,
@@ -199,81 +229,345 @@ def group_method_calls(filename, str_filter=None):
     contents = get_timer_contents(filename, str_filter)
     csv_reports = []
     csv_reports.append("parent,method,total,count,mean")
-    for method_name in contents.keys():
-        mean = float("{0:.2f}".format(
-            contents[method_name]['total'] / contents[method_name][
-                'count']))
-        # TODO: The below thresholds can be configurable
-        if contents[method_name]['total'] > 0 and mean > 0:
-            csv_reports.append(
-                "{},{},{},{},{}".format(contents[method_name]['parent'],
-                                        method_name,
-                                        contents[method_name]['total'],
-                                        contents[method_name]['count'],
-                                        mean
-                                        ))
+    with metrics.stage('aggregate'):
+        for method_name in contents.keys():
+            mean = float("{0:.2f}".format(
+                contents[method_name]['total'] / contents[method_name][
+                    'count']))
+            # TODO: The below thresholds can be configurable
+            if contents[method_name]['total'] > 0 and mean > 0:
+                csv_reports.append(
+                    "{},{},{},{},{}".format(contents[method_name]['parent'],
+                                            method_name,
+                                            contents[method_name]['total'],
+                                            contents[method_name]['count'],
+                                            mean
+                                            ))
     output_file_name = 'group_top_{}_{}.csv'.format(filename[-10:].replace('.', '_'), str_filter.replace('.', '_'))
     output_csv_file(output_file_name, csv_reports)
 
 def str_to_iso_datetime(timestamp):
     return datetime.strptime(timestamp, "%Y-%m-%dT%H:%M:%S.%fZ")
 
-def analyse_keyword(filename, keyword):
-    file = open(filename, "r")
-    lines = file.readlines()
-    keyword_lines = [k for k in lines if keyword in k]
-    print("========================{}=========================".format(filename))
-    print("There are [{}] out of [{}] lines contain [{}]".format(len(keyword_lines), len(lines), keyword))
-    if len(keyword_lines) > 0:
-        print("The first line starts with {} ... omitted...".format(keyword_lines[0][:100]))
-        print("The last line starts with {} ... omitted...".format(keyword_lines[-1][:100]))
-
-        if keyword_lines[0].startswith("[2020-"):
-            start_timestamp = keyword_lines[0][1:25]
-            end_timestamp = keyword_lines[-1][1:25]
-            print("Start {}, End {}".format(start_timestamp, end_timestamp))
-            print("Duration: {} seconds".format((str_to_iso_datetime(end_timestamp)-str_to_iso_datetime(start_timestamp)).seconds))
-
-        time_deltas = []
-        for i in range(len(keyword_lines)):
-            if i < len(keyword_lines) - 1:
-                i_datetime = str_to_iso_datetime(keyword_lines[i][1:25])
-                i_plus_datetime = str_to_iso_datetime(keyword_lines[i+1][1:25])
-                time_delta = i_plus_datetime - i_datetime
-                if time_delta.microseconds >= 0:
-                    time_deltas.append({
-                        "left": i_datetime.strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
-                        "right": i_plus_datetime.strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
-                        "delta": time_delta.microseconds
-                    })
-        time_delta_sum = sum(x["delta"] for x in time_deltas)
-        max_time_delta = max(x["delta"] for x in time_deltas)
-        # maxa = x for x in time_deltas if max_time_delta == x["delta"]
-        print("{} time gaps in between the lines have an average of {} microseconds".format(len(time_deltas), int(time_delta_sum/len(time_deltas))))
-        print("the longest gap is {} microseconds at {}".format(max_time_delta, [x["left"] for x in time_deltas if x["delta"] == max_time_delta]))
-
-        start_index = lines.index(keyword_lines[0])
-        end_index = lines.index(keyword_lines[-1])
-        print("There are {} lines in between the first match and the last".format(str(end_index - start_index)))
-        # pprint(time_deltas)
 
+def parse_time_bound(value, end=False):
+    """Normalise an ISO-8601 time given on the command line to the [...Z] timestamp format of the logs.
+
+    An end given to the second covers the whole of that second.
+    """
+    for ts_format in ["%Y-%m-%dT%H:%M:%S.%fZ", "%Y-%m-%dT%H:%M:%SZ", "%Y-%m-%dT%H:%M:%S.%f", "%Y-%m-%dT%H:%M:%S"]:
+        try:
+            parsed = datetime.strptime(value, ts_format)
+        except ValueError:
+            continue
+        if end and '%f' not in ts_format:
+            return parsed.strftime("%Y-%m-%dT%H:%M:%S") + '.999Z'
+        return parsed.strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + 'Z'
+    raise ValueError("Unsupported time [{}], expected ISO-8601 format e.g. 2020-02-07T20:55:10".format(value))
+
+
+def build_timestamp_index(filename, every=INDEX_EVERY_LINES):
+    """Record the byte offset and timestamp of every Nth line in one streaming pass over the log.
+
+    When the Nth line has no leading timestamp (e.g. a stack trace) the next line with one is recorded instead.
+    """
+    entries = []
+    offset = 0
+    pending = False
+    regex_evaluations = 0
+    with metrics.stage('index'), open(filename, "rb", buffering=READ_AHEAD_BYTES) as file:
+        for line_number, line in enumerate(file):
+            if line_number % every == 0:
+                pending = True
+            if pending and line.startswith(b'['):
+                regex_evaluations += 1
+                match = TIMESTAMP_PATTERN.match(line[:64].decode('ascii', 'replace'))
+                if match:
+                    entries.append([offset, match.group(1)])
+                    pending = False
+            offset += len(line)
+    metrics.count('index_bytes_read', offset)
+    metrics.count('regex_evaluations', regex_evaluations)
+    logging.info("Indexed {} timestamps of [{}]".format(len(entries), filename))
+    return entries
+
+
+def load_timestamp_index(filename):
+    """Return the sparse timestamp index of a log, building the sidecar file when missing or stale.
+
+    Returns None when there is no valid sidecar and it cannot be written next to the log, since building
+    the index on every query would cost more than reading the log without it.
+    """
+    index_file_name = filename + INDEX_FILE_SUFFIX
+    index_dir = os.path.dirname(os.path.abspath(index_file_name))
+    stat = os.stat(filename)
+    if os.path.exists(index_file_name):
+        try:
+            with open(index_file_name, "r") as index_file:
+                index = json.load(index_file)
+            if index['size'] == stat.st_size and index['mtime_ns'] == stat.st_mtime_ns:
+                return index['entries']
+            logging.info("Index [{}] is out of date".format(index_file_name))
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logging.warning("Index [{}] is damaged and will be rebuilt: {}".format(index_file_name, e))
+
+    if not os.access(index_dir, os.W_OK):
+        logging.warning("Unable to write index [{}], reading [{}] without it".format(index_file_name, filename))
+        return None
+    entries = build_timestamp_index(filename)
+    index = {
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'every': INDEX_EVERY_LINES,
+        'entries': entries
+    }
+    # Written to a temporary file of its own first, so neither a failed write nor a concurrent run
+    # indexing the same log leaves a partial index behind
+    temp_file_name = None
+    try:
+        with tempfile.NamedTemporaryFile("w", dir=index_dir, prefix=os.path.basename(index_file_name),
+                                         suffix='.tmp', delete=False) as index_file:
+            temp_file_name = index_file.name
+            json.dump(index, index_file)
+        os.replace(temp_file_name, index_file_name)
+    except OSError as e:
+        logging.warning("Unable to write index [{}]: {}".format(index_file_name, e))
+        if temp_file_name is not None and os.path.exists(temp_file_name):
+            os.remove(temp_file_name)
+    return entries
+
+
+def read_time_window(filename, start=None, end=None):
+    """Lazily yield batches of (timestamp, line) from a time-sorted log, keeping the lines between start and end.
+
+    With a start the sparse timestamp index is used to seek close to it, so only the window is read.
+    Lines without a leading timestamp (e.g. stack traces) take the timestamp of the line before them,
+    which is None for the lines before the first timestamp.
+    A batch holds the lines of one read-ahead buffer, which bounds the memory to one buffer per log.
+    """
+    offset = 0
+    if start is not None:
+        entries = load_timestamp_index(filename) or []
+        position = bisect.bisect_left([entry[1] for entry in entries], start)
+        if position > 0:
+            offset = entries[position - 1][0]
+
+    bytes_read = 0
+    regex_evaluations = 0
+    timestamp = None
+    in_window = start is None
+    past_end = False
+    try:
+        with open(filename, "rb", buffering=READ_AHEAD_BYTES) as file:
+            file.seek(offset)
+            while not past_end:
+                with metrics.stage('read'):
+                    raw_lines = file.readlines(READ_AHEAD_BYTES)
+                if not raw_lines:
+                    break
+                batch = []
+                with metrics.stage('parse'):
+                    for raw_line in raw_lines:
+                        bytes_read += len(raw_line)
+                        line = raw_line.decode('utf-8', 'replace')
+                        if line.startswith('['):
+                            regex_evaluations += 1
+                            match = TIMESTAMP_PATTERN.match(line)
+                            if match:
+                                timestamp = match.group(1)
+                                if end is not None and timestamp > end:
+                                    past_end = True
+                                    break
+                                in_window = start is None or timestamp >= start
+                        if in_window:
+                            batch.append((timestamp, line))
+                if batch:
+                    yield batch
+    finally:
+        metrics.count('bytes_read', bytes_read)
+        metrics.count('regex_evaluations', regex_evaluations)
+
+
+def build_indexes(filenames):
+    for filename in filenames:
+        load_timestamp_index(filename)
+
+
+def read_keyword_lines(filename, keyword, stats, start=None, end=None):
+    """Lazily yield (timestamp, node, line_number, line) for the lines of a time-sorted log containing the keyword.
+
+    The timestamp is None for the lines without a usable timestamp before them.
+    """
+    for batch in read_time_window(filename, start, end):
+        with metrics.stage('parse'):
+            matches = [(timestamp, filename, stats['lines'] + i, line)
+                       for i, (timestamp, line) in enumerate(batch)
+                       if keyword in line]
+            stats['lines'] += len(batch)
+        yield from matches
+
+
+def new_keyword_stats():
+    return {
+        'lines': 0,
+        'matches': 0,
+        'first': None,
+        'last': None,
+        'untimed': 0,
+        'first_timed': None,
+        'last_timed': None,
+        'last_datetime': None,
+        'gaps': 0,
+        'gap_sum': 0,
+        'max_gap': None,
+        'max_gap_at': None,
+        'out_of_order': 0
+    }
 
 
+def add_keyword_match(stats, timestamp, node, line_number, line, current_datetime):
+    stats['matches'] += 1
+    match = {'timestamp': timestamp, 'node': node, 'line_number': line_number, 'line': line[:100].rstrip('\n')}
+    if stats['first'] is None:
+        stats['first'] = match
+    stats['last'] = match
+    # Matches without a timestamp are counted but left out of the time stats
+    if timestamp is None:
+        stats['untimed'] += 1
+        return
+    if stats['last_timed'] is not None:
+        gap = (current_datetime - stats['last_datetime']) // timedelta(microseconds=1)
+        if gap < 0:
+            stats['out_of_order'] += 1
+        stats['gaps'] += 1
+        stats['gap_sum'] += gap
+        if stats['max_gap'] is None or gap > stats['max_gap']:
+            stats['max_gap'] = gap
+            stats['max_gap_at'] = (stats['last_timed']['timestamp'], stats['last_timed']['node'], timestamp, node)
+    if stats['first_timed'] is None:
+        stats['first_timed'] = match
+    stats['last_timed'] = match
+    stats['last_datetime'] = current_datetime
+
+
+def print_keyword_stats(stats, keyword, fleet=False):
+    print("There are [{}] out of [{}] lines contain [{}]".format(stats['matches'], stats['lines'], keyword))
+    if stats['matches'] == 0:
+        return
+    if fleet:
+        print("The first line is from [{}] and starts with {} ... omitted...".format(stats['first']['node'],
+                                                                                    stats['first']['line']))
+        print("The last line is from [{}] and starts with {} ... omitted...".format(stats['last']['node'],
+                                                                                   stats['last']['line']))
+    else:
+        print("The first line starts with {} ... omitted...".format(stats['first']['line']))
+        print("The last line starts with {} ... omitted...".format(stats['last']['line']))
+    if stats['first_timed'] is not None:
+        start_timestamp = stats['first_timed']['timestamp']
+        end_timestamp = stats['last_timed']['timestamp']
+        print("Start {}, End {}".format(start_timestamp, end_timestamp))
+        print("Duration: {} seconds".format(
+            int((str_to_iso_datetime(end_timestamp) - str_to_iso_datetime(start_timestamp)).total_seconds())))
+    if stats['gaps'] > 0:
+        print("{} time gaps in between the lines have an average of {} microseconds".format(
+            stats['gaps'], int(stats['gap_sum'] / stats['gaps'])))
+        left_timestamp, left_node, right_timestamp, right_node = stats['max_gap_at']
+        if fleet:
+            print("the longest gap is {} microseconds between [{}] on [{}] and [{}] on [{}]".format(
+                stats['max_gap'], left_timestamp, left_node, right_timestamp, right_node))
+        else:
+            print("the longest gap is {} microseconds between [{}] and [{}]".format(
+                stats['max_gap'], left_timestamp, right_timestamp))
+    if not fleet:
+        print("There are {} lines in between the first match and the last".format(
+            stats['last']['line_number'] - stats['first']['line_number']))
+    if stats['untimed'] > 0:
+        logging.warning("{} of the matching lines have no [yyyy-MM-ddTHH:mm:ss.SSSZ] timestamp before them "
+                        "and are left out of the time stats".format(stats['untimed']))
+    if stats['out_of_order'] > 0:
+        logging.warning("{} lines are earlier than the line before them, is the log sorted by time?".format(
+            stats['out_of_order']))
+
+
+def analyse_keyword(filenames, keyword, start=None, end=None):
+    """Analyse the occurrence of the keyword in one or more time-sorted logs, e.g. one per node.
+
+    The logs are merged lazily by timestamp with a k-way merge, with more than one log the stats are
+    reported for the whole fleet and then for each node.
+    """
+    fleet_stats = new_keyword_stats()
+    node_stats = {filename: new_keyword_stats() for filename in filenames}
+    node_lines = [read_keyword_lines(filename, keyword, node_stats[filename], start, end) for filename in filenames]
+
+    # Reading and parsing the logs happen lazily inside the merge, their stages are timed on their own
+    with metrics.stage('aggregate'):
+        # Matches without a timestamp can only come before the first timestamp of a log, so they sort first
+        for timestamp, node, line_number, line in heapq.merge(*node_lines, key=lambda entry: entry[0] or ''):
+            current_datetime = str_to_iso_datetime(timestamp) if timestamp is not None else None
+            add_keyword_match(fleet_stats, timestamp, node, line_number, line, current_datetime)
+            add_keyword_match(node_stats[node], timestamp, node, line_number, line, current_datetime)
+    fleet_stats['lines'] = sum(stats['lines'] for stats in node_stats.values())
+    metrics.count('rows_read', fleet_stats['lines'])
+    metrics.count('keyword_evaluations', fleet_stats['lines'])
+
+    if len(filenames) == 1:
+        print("========================{}=========================".format(filenames[0]))
+    else:
+        print("========================{} nodes=========================".format(len(filenames)))
+    if start is not None or end is not None:
+        print("Between {} and {}".format(start or 'the start', end or 'the end'))
+    if len(filenames) == 1:
+        print_keyword_stats(node_stats[filenames[0]], keyword)
+        return
+    print_keyword_stats(fleet_stats, keyword, fleet=True)
+    for filename in filenames:
+        print("------------------------{}-------------------------".format(filename))
+        print_keyword_stats(node_stats[filename], keyword)
+
+
+
+def pop_option(argv, name, has_value=True):
+    if name not in argv:
+        return None
+    index = argv.index(name)
+    if not has_value:
+        del argv[index]
+        return True
+    if index + 1 >= len(argv) or argv[index + 1].startswith('--'):
+        sys.exit("Missing value for option {}".format(name))
+    value = argv[index + 1]
+    del argv[index:index + 2]
+    return value
 
 
 def main(argv):
-    if argv[1] == 'hibernate':
-        read_hibernate_statistics(argv[2])
-    elif argv[1] == 'diff':
-        result = compare_timers(argv[2], argv[3])
-        output_compare_timers_result(argv[2], argv[3], result)
-    elif argv[1] == 'group':
-        if argv[2] == 'filter':
-            group_method_calls(argv[4], argv[3])
-        else:
-            group_method_calls(argv[2])
-    elif argv[1] == 'keyword':
-        analyse_keyword(argv[2], argv[3])
+    argv = list(argv)
+    metrics_out = pop_option(argv, '--metrics-out')
+    profile = pop_option(argv, '--profile', has_value=False) is not None
+    start = pop_option(argv, '--from')
+    end = pop_option(argv, '--to')
+    if start is not None:
+        start = parse_time_bound(start)
+    if end is not None:
+        end = parse_time_bound(end, end=True)
+
+    with metrics.collect('loganalyser', metrics_out, profile):
+        if argv[1] == 'hibernate':
+            read_hibernate_statistics(argv[2])
+        elif argv[1] == 'diff':
+            result = compare_timers(argv[2], argv[3])
+            output_compare_timers_result(argv[2], argv[3], result)
+        elif argv[1] == 'group':
+            if argv[2] == 'filter':
+                group_method_calls(argv[4], argv[3])
+            else:
+                group_method_calls(argv[2])
+        elif argv[1] == 'keyword':
+            if len(argv) < 4:
+                sys.exit("Usage: loganalyser.py keyword <path_to_test_logs> [<path_to_test_logs> ...] <keyword>")
+            analyse_keyword(argv[2:-1], argv[-1], start, end)
+        elif argv[1] == 'index':
+            build_indexes(argv[2:])
 
 
 main(sys.argv)
@@ -0,0 +1,112 @@
+#!/usr/bin/python
+
+import cProfile
+import json
+import logging
+import os
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, peak RSS is reported as None there
+    resource = None
+
+stages = {}
+counters = {}
+active_stages = []
+
+
+@contextmanager
+def stage(name):
+    """Time the enclosed block as the named stage.
+
+    The time spent in a nested stage is only counted for the nested stage, not for the one around it,
+    so the stage times add up to at most the wall time.
+    """
+    frame = {'nested_seconds': 0.0}
+    active_stages.append(frame)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        active_stages.pop()
+        if active_stages:
+            active_stages[-1]['nested_seconds'] += elapsed
+        add_time(name, elapsed - frame['nested_seconds'])
+
+
+def add_time(name, seconds, calls=1):
+    if name not in stages:
+        stages[name] = {'seconds': 0.0, 'calls': 0}
+    stages[name]['seconds'] += seconds
+    stages[name]['calls'] += calls
+
+
+def count(name, value=1):
+    counters[name] = counters.get(name, 0) + value
+
+
+def peak_rss_bytes():
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux but in bytes on macOS
+    if os.uname().sysname == 'Darwin':
+        return max_rss
+    return max_rss * 1024
+
+
+def snapshot(wall_seconds=None):
+    return {
+        'timestamp': datetime.now().isoformat(),
+        'wall_seconds': wall_seconds,
+        'peak_rss_bytes': peak_rss_bytes(),
+        'stages': {k: {'seconds': float("{0:.6f}".format(v['seconds'])), 'calls': v['calls']}
+                   for k, v in stages.items()},
+        'counters': dict(counters)
+    }
+
+
+def log_summary(report):
+    logging.info("Wall time: {0:.3f} seconds, peak RSS: {1} bytes".format(report['wall_seconds'],
+                                                                         report['peak_rss_bytes']))
+    for name, value in report['stages'].items():
+        logging.info("Stage [{0}]: {1:.6f} seconds in {2} call(s)".format(name, value['seconds'], value['calls']))
+    for name, value in report['counters'].items():
+        logging.info("Counter [{}]: {}".format(name, value))
+
+
+@contextmanager
+def collect(name, metrics_out=None, profile=False):
+    """Time the enclosed run and report the collected stages and counters.
+
+    With metrics_out the report is written as JSON to that file, with profile the run is wrapped in
+    cProfile and the stats are dumped next to it (or to <name>.prof).
+    """
+    profiler = cProfile.Profile() if profile else None
+    start = time.perf_counter()
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+        report = snapshot(time.perf_counter() - start)
+        if profile or metrics_out is not None:
+            log_summary(report)
+        if metrics_out is not None:
+            with open(metrics_out, "w") as metrics_file:
+                json.dump(report, metrics_file, indent=2)
+            logging.info("Metrics are written to [{}]".format(metrics_out))
+        if profiler is not None:
+            if metrics_out is not None:
+                profile_out = "{}.prof".format(os.path.splitext(metrics_out)[0])
+            else:
+                profile_out = "{}.prof".format(name)
+            profiler.dump_stats(profile_out)
+            logging.info("cProfile stats are written to [{}]".format(profile_out))